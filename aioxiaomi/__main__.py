@@ -25,286 +25,469 @@ import sys
 import asyncio as aio
 import aioxiaomi as aiox
 from functools import partial
-import argparse
-from random import randint
+import bisect
+from random import getrandbits
 
 UDP_BROADCAST_PORT = 56700
 
+_BOI_MENU_TAIL = (
+    "\t[1]\tPower (on or off)\n"
+    "\t[2]\tWhite (Brigthness Temperature)\n"
+    "\t[3]\tColour (Hue Saturation Brightness)\n"
+    "\t[4]\tSlow Colour Change (Duration Hue Saturation Brightness)\n"
+    "\t[5]\tInfo\n"
+    "\t[6]\tSet Name (Bulb name)\n"
+    "\t[7]\tPulse (Red Green Blue)\n"
+    "\t[8]\tStress (Number of colour changes)\n"
+    "\t[9]\tStart/Stop Music mode (start or stop)\n"
+    "\n"
+    "\t[0]\tBack to bulb selection\n"
+)
+_SELECT_BULB_HEADER = "Select Bulb:\n"
+_SELECT_BULB_TAIL = "\n\t[A]\tAll bulbs: Power (on or off)\n"
+_PROMPT = "\nYour choice: "
+
+
+def _extract_id(headers):
+    """Same as the bulb_id that XiaomiBulb will derive from the headers"""
+    try:
+        return int(headers["id"], base=16)
+    except:
+        return None
+
+
+def _print_unexpected(msg):
+    print("Unexpected message:", msg)
+
+
 # Simple bulb control from console
 class bulbs:
     """ A simple class with a register and  unregister methods
     """
 
-    def __init__(self):
+    def __init__(self, loop):
+        self.loop = loop
         self.bulbs = []
-        self.pending_bulbs = []
+        self._keys = []  # Sort keys, parallel to self.bulbs
+        self._by_id = {}
+        self._pending_by_id = {}
         self.boi = None  # bulb of interest
+        self.changes = 0  # Bumped whenever the bulb list changes
+        self.shown = None  # Value of changes when the list was last displayed
+
+    def _insert(self, bulb, key):
+        bulb._sort_key = key
+        idx = bisect.bisect_left(self._keys, key)
+        self._keys.insert(idx, key)
+        self.bulbs.insert(idx, bulb)
+        self.changes += 1
+
+    def _remove(self, bulb):
+        idx = bisect.bisect_left(self._keys, bulb._sort_key)
+        while idx < len(self.bulbs) and self._keys[idx] == bulb._sort_key:
+            if self.bulbs[idx] is bulb:
+                del self.bulbs[idx]
+                del self._keys[idx]
+                self.changes += 1
+                break
+            idx += 1
+
+    def rename(self, bulb, name):
+        """Keep the list sorted when a bulb changes name"""
+        key = name or str(bulb.bulb_id)
+        if key != bulb._sort_key:
+            self._remove(bulb)
+            self._insert(bulb, key)
 
     def register(self, bulb):
         global opts
         # print("Adding bulb {} {} {}".format(bulb,bulb.name,bulb.bulb_id))
-        self.bulbs.append(bulb)
-        self.bulbs.sort(key=lambda x: x.name or str(x.bulb_id))
+        self._insert(bulb, bulb.name or str(bulb.bulb_id))
+        self._by_id[bulb.bulb_id] = bulb
         if opts.extra:
-            bulb.register_callback(lambda y: print("Unexpected message: %s" % str(y)))
-        try:
-            self.pending_bulbs.remove(bulb)
-        except:
-            pass
+            bulb.register_callback(_print_unexpected)
+        self._pending_by_id.pop(bulb.bulb_id, None)
 
     def unregister(self, bulb):
-        idx = 0
-        for x in list([y.bulb_id for y in self.bulbs]):
-            if x == bulb.bulb_id:
-                del self.bulbs[idx]
-                break
-            idx += 1
+        abulb = self._by_id.pop(bulb.bulb_id, None)
+        if abulb:
+            self._remove(abulb)
 
     def new_bulb(self, address, headers):
-        newbulb = aiox.XiaomiBulb(aio.get_event_loop(), headers, self)
-        found = False
-        for abulb in self.bulbs:
-            if abulb.bulb_id == newbulb.bulb_id:
-                found = True
-                break
-        if not found:
-            for abulb in self.pending_bulbs:
-                if abulb.bulb_id == newbulb.bulb_id:
-                    found = True
-                    break
-
-        if not found:
-            # print("Activating bulb {} with id {}".format(newbulb,newbulb.bulb_id))
-            self.pending_bulbs.append(newbulb)
-            newbulb.set_connections(2)  # Open 2 channels to the bulb
-            newbulb.set_queue_limit(5, "adapt")
-            newbulb.activate()
-        else:
-            del newbulb
+        bid = _extract_id(headers)
+        if bid in self._by_id or bid in self._pending_by_id:
+            return
+
+        newbulb = aiox.XiaomiBulb(self.loop, headers, self)
+        # print("Activating bulb {} with id {}".format(newbulb,newbulb.bulb_id))
+        self._pending_by_id[newbulb.bulb_id] = newbulb
+        newbulb.set_connections(2)  # Open 2 channels to the bulb
+        newbulb.set_queue_limit(5, "adapt")
+        newbulb.activate()
+
+
+_FLOOD_STEP = 50  # msecs per colour change
+_FLOOD_CHUNK = 9  # colour changes per flow message
 
 
 async def flood_weelight(light, count):
-    for x in range(0, count):
-        thiscol = randint(0, 16777215)
-        light.set_rgb_direct(thiscol, light.brightness)
-        await aio.sleep(0.05)
+    while count > 0:
+        nb = min(count, _FLOOD_CHUNK)
+        flex = []
+        for x in range(nb):
+            flex += [
+                _FLOOD_STEP,
+                aiox.Mode.RGB.value,
+                getrandbits(24),
+                light.brightness,
+            ]
+        if not light.start_flow(nb, "stop", flex):
+            # Flows need start_cf and the light on, set_scene needs neither
+            for x in range(2, len(flex), 4):
+                if not light.set_rgb_direct(flex[x], light.brightness):
+                    print("Error: Stress test not supported by this bulb\n")
+                    return
+                await aio.sleep(_FLOOD_STEP / 1000.0)
+        else:
+            await aio.sleep(nb * _FLOOD_STEP / 1000.0)
+        count -= nb
+
+
+_MUSIC_DONE = {"start": "Music Mode was started", "stop": "Music Mode was stopped"}
 
 
 def start_music_result(cmd, data):
     if "error" in data:
         print("Music Mode could not {}".format(cmd))
     elif "result" in data and data["result"] == ["ok"]:
-        print("Music Mode was {}{}ed".format(cmd, cmd == "stop" and "p" or ""))
+        print(_MUSIC_DONE[cmd])
     else:
         print("Don't know what this response to {} is: {}".format(cmd, data))
 
 
-def readin():
-    """Reading from stdin and displaying menu"""
+_MUSIC_CBS = {
+    "start": partial(start_music_result, "start"),
+    "stop": partial(start_music_result, "stop"),
+}
+
+
+def _back(lov):
+    MyBulbs.boi = None
+
+
+def _power(lov):
+    boi = MyBulbs.boi
+    if len(lov) > 1 and lov[1].lower() in ["on", "off"]:
+        boi.set_power(lov[1].lower())
+        MyBulbs.boi = None
+    else:
+        print("Error: For power you must indicate on or off\n")
+
+
+def _clamp(s, lo, hi):
+    """Round a numeric string to an int within [lo, hi]"""
+    v = int(float(s) + 0.5)
+    return lo if v < lo else hi if v > hi else v
+
+
+def _white(lov):
+    boi = MyBulbs.boi
+    if len(lov) > 2:
+        try:
+            boi.set_white_direct(_clamp(lov[2], 1700, 6500), _clamp(lov[1], 0, 100))
+
+            MyBulbs.boi = None
+        except:
+            print(
+                "Error: For white brightness (0-100) and temperature (1700-6500) must be numbers.\n"
+            )
+    else:
+        print(
+            "Error: For white you must indicate brightness (0-100) and temperature (1700-6500)\n"
+        )
+
+
+def _colour(lov):
+    boi = MyBulbs.boi
+    if len(lov) > 3:
+        try:
+            boi.set_hsv_direct(
+                _clamp(lov[1], 0, 359), _clamp(lov[2], 0, 100), _clamp(lov[3], 0, 100)
+            )
+            MyBulbs.boi = None
+        except:
+            print(
+                "Error: For colour Hue (0-359), Saturation (0-100) and Brightness (0-100)) must be numbers.\n"
+            )
+    else:
+        print(
+            "Error: For colour you must indicate Hue (0-359), Saturation (0-100) and Brightess (0-100)\n"
+        )
+
+
+def _slow_colour(lov):
+    boi = MyBulbs.boi
+    if len(lov) > 4:
+        try:
+            duration = int(float(lov[1]) * 1000 + 0.5)
+            boi.set_hsv(
+                _clamp(lov[2], 0, 359), _clamp(lov[3], 0, 100), "smooth", duration
+            )
+            boi.set_brightness(_clamp(lov[4], 0, 100), "smooth", duration)
+            MyBulbs.boi = None
+        except:
+            print(
+                "Error: For Smooth colour Duration, Hue (0-359), Saturation (0-100) and Brightness (0-100)) must be numbers.\n"
+            )
+    else:
+        print(
+            "Error: For Smooth colour you must indicate Hue (0-359), Saturation (0-100) and Brightness (0-100)\n"
+        )
+
+
+def _info(lov):
+    boi = MyBulbs.boi
+    for prop in boi.properties:
+        print("\t{}:\t{}".format(prop.title(), boi.properties[prop]))
+    print("\tMessage Queue:\t{}".format(len(boi.message_queue)))
+    MyBulbs.boi = None
+
+
+def _set_name(lov):
+    boi = MyBulbs.boi
+    try:
+        newname = " ".join(lov[1:])
+        boi.set_name(newname)
+        MyBulbs.rename(boi, newname)
+        MyBulbs.boi = None
+    except:
+        print("Error: Could not set name\n")
+
+
+def _pulse(lov):
+    boi = MyBulbs.boi
+    if len(lov) > 3:
+        # try:
+        boi.start_flow(
+            10,
+            "start",
+            [
+                100,
+                aiox.Mode.RGB.value,
+                int(
+                    round(float(lov[1]) * 65535.0 + float(lov[2]) * 256 + float(lov[3]))
+                ),
+                boi.brightness,
+                100,
+                aiox.Mode.RGB.value,
+                int(boi.properties.get("rgb", 0)),
+                boi.brightness,
+            ],
+        )
+        MyBulbs.boi = None
+        # except:
+        # print("Error: For pulse Red (0-255), Green (0-255) and Blue (0-255) must be numbers.\n")
+    else:
+        print(
+            "Error: For pulse you must indicate Red (0-255), Green (0-255) and Blue (0-255)\n"
+        )
+
+
+_STRESS_TASKS = set()  # Keeps the running floods referenced
+
+
+def _stress(lov):
+    # try:
+    count = int(lov[1])
+    task = aio.ensure_future(flood_weelight(MyBulbs.boi, count))
+    _STRESS_TASKS.add(task)
+    task.add_done_callback(_STRESS_TASKS.discard)
+    MyBulbs.boi = None
+    # except:
+    # print("Error: For Stress you must specify a count (Integer)\n")
+
+
+def _music(lov):
+    boi = MyBulbs.boi
+    cmd = str(lov[1]).lower()
+    if cmd not in ["start", "stop"]:
+        print('Error: For "music mode" you must indicate "start" or "stop"\n')
+    else:
+        boi.set_music(cmd, 0, _MUSIC_CBS[cmd])
+        MyBulbs.boi = None
+
+
+def _fan_out(method_name, *args):
+    """Call the same method on all the bulbs"""
+    for abulb in MyBulbs.bulbs:
+        getattr(abulb, method_name)(*args)
+
+
+def _all_power(lov):
+    if len(lov) > 1 and lov[1].lower() in ["on", "off"]:
+        _fan_out("set_power", lov[1].lower())
+    else:
+        print("Error: For power you must indicate on or off\n")
+
+
+_HANDLERS = {
+    0: _back,
+    1: _power,
+    2: _white,
+    3: _colour,
+    4: _slow_colour,
+    5: _info,
+    6: _set_name,
+    7: _pulse,
+    8: _stress,
+    9: _music,
+}
+
+
+def readin(selection):
+    """Handling a line read from stdin and displaying menu"""
     global MyBulbs
 
-    selection = sys.stdin.readline().strip("\n")
-    MyBulbs.bulbs.sort(key=lambda x: x.name or str(x.bulb_id))
-    lov = [x for x in selection.split(" ") if x != ""]
-    if lov:
-        if MyBulbs.boi:
-            # try:
-            if True:
-                if int(lov[0]) == 0:
-                    MyBulbs.boi = None
-                elif int(lov[0]) == 1:
-                    if len(lov) > 1 and lov[1].lower() in ["on", "off"]:
-                        MyBulbs.boi.set_power(lov[1].lower())
-                        MyBulbs.boi = None
-                    else:
-                        print("Error: For power you must indicate on or off\n")
-                elif int(lov[0]) == 2:
-                    if len(lov) > 2:
-                        try:
-                            MyBulbs.boi.set_white_direct(
-                                int(round(float(lov[2]))),
-                                min(100, int(round(float(lov[1])))),
-                            )
-
-                            MyBulbs.boi = None
-                        except:
-                            print(
-                                "Error: For white brightness (0-100) and temperature (1700-6500) must be numbers.\n"
-                            )
-                    else:
-                        print(
-                            "Error: For white you must indicate brightness (0-100) and temperature (1700-6500)\n"
-                        )
-                elif int(lov[0]) == 3:
-                    if len(lov) > 3:
-                        try:
-                            MyBulbs.boi.set_hsv_direct(
-                                min(359, int(round(float(lov[1])))),
-                                int(round(float(lov[2]))),
-                                int(round(float(lov[3]))),
-                            )
-                            MyBulbs.boi = None
-                        except:
-                            print(
-                                "Error: For colour Hue (0-359), Saturation (0-100) and Brightness (0-100)) must be numbers.\n"
-                            )
-                    else:
-                        print(
-                            "Error: For colour you must indicate Hue (0-359), Saturation (0-100) and Brightess (0-100)\n"
-                        )
-
-                elif int(lov[0]) == 4:
-                    if len(lov) > 4:
-                        # try:
-                        MyBulbs.boi.set_hsv(
-                            min(359, int(round(float(lov[2])))),
-                            int(round(float(lov[3]))),
-                            "smooth",
-                            int(round(float(lov[1]) * 1000)),
-                        )
-                        MyBulbs.boi.set_brightness(
-                            min(100, int(round(float(lov[4])))),
-                            "smooth",
-                            int(round(float(lov[1]) * 1000)),
-                        )
-                        MyBulbs.boi = None
-                        # except:
-                        # print("Error: For Smooth colour Duration, Hue (0-359), Saturation (0-100) and Brightness (0-100)) must be numbers.\n")
-                    else:
-                        print(
-                            "Error: For Smooth colour you must indicate Hue (0-359), Saturation (0-100) and Brightness (0-100)\n"
-                        )
-                elif int(lov[0]) == 5:
-                    for prop in MyBulbs.boi.properties:
-                        print(
-                            "\t{}:\t{}".format(
-                                prop.title(), MyBulbs.boi.properties[prop]
-                            )
-                        )
-                    print("\tMessage Queue:\t{}".format(len(MyBulbs.boi.message_queue)))
-                    MyBulbs.boi = None
-                elif int(lov[0]) == 6:
-                    try:
-                        MyBulbs.boi.set_name(" ".join(lov[1:]))
-                        MyBulbs.boi = None
-                    except:
-                        print("Error: Could not set name\n")
-                elif int(lov[0]) == 7:
-                    if len(lov) > 3:
-                        # try:
-                        MyBulbs.boi.start_flow(
-                            10,
-                            "start",
-                            [
-                                100,
-                                aiox.Mode.RGB.value,
-                                int(
-                                    round(
-                                        float(lov[1]) * 65535.0
-                                        + float(lov[2]) * 256
-                                        + float(lov[3])
-                                    )
-                                ),
-                                MyBulbs.boi.brightness,
-                                100,
-                                aiox.Mode.RGB.value,
-                                MyBulbs.boi.rgb,
-                                MyBulbs.boi.brightness,
-                            ],
-                        )
-                        MyBulbs.boi = None
-                        # except:
-                        # print("Error: For pulse Red (0-255), Green (0-255) and Blue (0-255) must be numbers.\n")
-                    else:
-                        print(
-                            "Error: For pulse you must indicate Red (0-255), Green (0-255) and Blue (0-255)\n"
-                        )
-                elif int(lov[0]) == 8:
-                    # try:
-                    count = int(lov[1])
-                    aio.ensure_future(flood_weelight(MyBulbs.boi, count))
-                    MyBulbs.boi = None
-                    # except:
-                    # print("Error: For Stress you must specify a count (Integer)\n")
-                elif int(lov[0]) == 9:
-                    cmd = str(lov[1]).lower()
-                    if cmd not in ["start", "stop"]:
-                        print(
-                            'Error: For "music mode" you must indicate "start" or "stop"\n'
-                        )
-                    else:
-                        MyBulbs.boi.set_music(cmd, 0, partial(start_music_result, cmd))
-                        MyBulbs.boi = None
-
-            # except:
-            # print ("\nError: Selection must be a number.\n")
+    lov = selection.split()
+    if not lov and not MyBulbs.boi and MyBulbs.shown == MyBulbs.changes:
+        sys.stdout.write("Your choice: ")
+        sys.stdout.flush()
+        return
+    if lov and not MyBulbs.boi and lov[0].lower() == "a":
+        _all_power(lov)
+    elif lov:
+        try:
+            op = int(lov[0])
+        except ValueError:
+            print("\nError: Selection must be a number.\n")
         else:
-            try:
-                if int(lov[0]) > 0:
-                    if int(lov[0]) <= len(MyBulbs.bulbs):
-                        MyBulbs.boi = MyBulbs.bulbs[int(lov[0]) - 1]
-                    else:
-                        print("\nError: Not a valid selection.\n")
-
-            except:
-                print("\nError: Selection must be a number.\n")
+            if MyBulbs.boi:
+                handler = _HANDLERS.get(op)
+                if handler:
+                    handler(lov)
+            elif op > 0:
+                if op <= len(MyBulbs.bulbs):
+                    MyBulbs.boi = MyBulbs.bulbs[op - 1]
+                else:
+                    print("\nError: Not a valid selection.\n")
 
     if MyBulbs.boi:
-        print("Select Function for {}:".format(MyBulbs.boi.name))
-        print("\t[1]\tPower (on or off)")
-        print("\t[2]\tWhite (Brigthness Temperature)")
-        print("\t[3]\tColour (Hue Saturation Brightness)")
-        print("\t[4]\tSlow Colour Change (Duration Hue Saturation Brightness)")
-        print("\t[5]\tInfo")
-        print("\t[6]\tSet Name (Bulb name)")
-        print("\t[7]\tPulse (Red Green Blue)")
-        print("\t[8]\tStress (Number of colour changes)")
-        print("\t[9]\tStart/Stop Music mode (start or stop)")
-        print("")
-        print("\t[0]\tBack to bulb selection")
+        sys.stdout.write(
+            "Select Function for {}:\n".format(MyBulbs.boi.name)
+            + _BOI_MENU_TAIL
+            + _PROMPT
+        )
     else:
-        idx = 1
-        print("Select Bulb:")
-        for x in MyBulbs.bulbs:
-            print("\t[{}]\t{}".format(idx, x.name or x.bulb_id))
-            idx += 1
-    print("")
-    print("Your choice: ", end="", flush=True)
+        MyBulbs.shown = MyBulbs.changes
+        sys.stdout.write(
+            _SELECT_BULB_HEADER
+            + "".join(
+                "\t[{}]\t{}\n".format(idx, x.name or x.bulb_id)
+                for idx, x in enumerate(MyBulbs.bulbs, 1)
+            )
+            + _SELECT_BULB_TAIL
+            + _PROMPT
+        )
+    sys.stdout.flush()
+
+
+async def menu_loop(loop):
+    """Reading stdin lines without blocking the loop"""
+    reader = aio.StreamReader()
+    protocol = aio.StreamReaderProtocol(reader)
+    try:
+        await loop.connect_read_pipe(lambda: protocol, sys.stdin)
+    except Exception as e:
+        print("Error: Cannot read commands from stdin ({})".format(e))
+        return
+    while True:
+        line = await reader.readline()
+        if not line:
+            break
+        try:
+            readin(line.decode())
+        except Exception as e:
+            # Keep reading, a bad entry must not stop the menu
+            print("Error: {!r}\n".format(e))
+            sys.stdout.write(_PROMPT)
+            sys.stdout.flush()
+
+
+_USAGE = """usage: aioxiaomi [-h] [-x] [-d] [--no-uvloop]
+
+Track and interact with Yeelight light bulbs.
+
+optional arguments:
+  -h, --help    show this help message and exit
+  -x, --extra   Print unexpected messages.
+  -d, --debug   Print debug info
+  --no-uvloop   Do not use uvloop even if it is available.
+"""
+
+
+class _Opts:
+    extra = False
+    debug = False
+    no_uvloop = False
+
+
+_LONG_OPTS = ("--help", "--extra", "--debug", "--no-uvloop")
+
+
+def _parse_opts(argv):
+    opts = _Opts()
+    args = []
+    for arg in argv:
+        if len(arg) > 2 and arg[0] == "-" and arg[1] != "-":
+            args += ["-" + c for c in arg[1:]]  # Grouped short flags, e.g. -xd
+        elif arg.startswith("--"):
+            # Unambiguous abbreviations, as argparse allows
+            match = [x for x in _LONG_OPTS if x.startswith(arg)]
+            args.append(match[0] if len(match) == 1 else arg)
+        else:
+            args.append(arg)
+    for arg in args:
+        if arg in ("-h", "--help"):
+            sys.stdout.write(_USAGE)
+            sys.exit(0)
+        elif arg in ("-x", "--extra"):
+            opts.extra = True
+        elif arg in ("-d", "--debug"):
+            opts.debug = True
+        elif arg == "--no-uvloop":
+            opts.no_uvloop = True
+        else:
+            sys.stderr.write(_USAGE.split("\n")[0] + "\n")
+            sys.stderr.write("aioxiaomi: error: unrecognized argument: " + arg + "\n")
+            sys.exit(2)
+    return opts
 
 
 def main(args=None):
     global MyBulbs
     global opts
 
-    parser = argparse.ArgumentParser(
-        description="Track and interact with Yeelight light bulbs."
-    )
-    parser.add_argument(
-        "-x",
-        "--extra",
-        action="store_true",
-        default=False,
-        help="Print unexpected messages.",
-    )
-    parser.add_argument(
-        "-d", "--debug", action="store_true", default=False, help="Print debug info"
-    )
-    try:
-        opts = parser.parse_args()
-    except Exception as e:
-        parser.error("Error: " + str(e))
+    opts = _parse_opts(sys.argv[1:] if args is None else args)
 
     if opts.debug:
         import logging
 
         logging.basicConfig(level=logging.DEBUG)
 
-    MyBulbs = bulbs()
+    if not opts.no_uvloop and sys.platform != "win32":
+        try:
+            import uvloop
+
+            uvloop.install()
+        except ImportError:
+            pass
+
     loop = aio.get_event_loop()
-    myfuture = aiox.start_xiaomi_discovery(MyBulbs.new_bulb)
+    MyBulbs = bulbs(loop)
+    myfuture = aiox.start_xiaomi_discovery(MyBulbs.new_bulb, loop)
     myfuture.add_done_callback(lambda f: f.result().broadcast(2))
+    menu = loop.create_task(menu_loop(loop))
     try:
-        loop.add_reader(sys.stdin, readin)
         print('Hit "Enter" to start')
         print("Use Ctrl-C to quit")
         loop.run_forever()
@@ -313,7 +496,7 @@ def main(args=None):
     finally:
         print("Exiting at user's request.")
         myfuture.result().close()
-        loop.remove_reader(sys.stdin)
+        menu.cancel()
         loop.run_until_complete(aio.sleep(2))
         loop.close()
 
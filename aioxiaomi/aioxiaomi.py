@@ -24,14 +24,47 @@
 # IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE
 
 import asyncio as aio
-import json
-from functools import partial
+from functools import partial, lru_cache
+from operator import attrgetter
+from collections import deque
 from enum import IntEnum
 from uuid import uuid4
-import datetime as dt
 from random import randint
 import socket
 import logging
+from urllib.parse import urlsplit
+
+log = logging.getLogger(__name__)
+
+try:
+    import orjson as _json
+
+    _dumps = _json.dumps
+except ImportError:
+    try:
+        import ujson as _json
+
+        def _dumps(msg):
+            return _json.dumps(msg).encode()
+
+    except ImportError:
+        import json as _json
+
+        # Compact like orjson and ujson, json.dumps adds spaces after separators
+        _encoder = _json.JSONEncoder(separators=(",", ":"), ensure_ascii=False).encode
+
+        def _dumps(msg):
+            return _encoder(msg).encode()
+
+
+if hasattr(aio, "timeout"):  # Python 3.11+
+    _timeout = aio.timeout
+else:
+    try:
+        from async_timeout import timeout as _timeout
+    except ImportError:
+        _timeout = None
+
 
 PROPERTIES = [
     "power",
@@ -77,10 +110,69 @@ INT_PROPERTIES = [
     "color_mode",
 ]
 HEX_PROPERTIES = ["id"]
+# For fast membership tests
+_PROPERTIES_SET = frozenset(PROPERTIES)
+# How to convert property values, properties not listed here are kept as is
+_COERCE = {name: int for name in INT_PROPERTIES}
+_COERCE.update({name: partial(int, base=16) for name in HEX_PROPERTIES})
 
 DEFAULT_TIMEOUT = 1.0  # How long to wait for a response
 DEFAULT_ATTEMPTS = 1  # How many times to try
-MESSAGE_WINDOW = 256
+MESSAGE_WINDOW = 1 << 31  # Wide enough that pending ids never collide
+_SEQ_MASK = MESSAGE_WINDOW - 1  # The window is a power of 2
+PENDING_SLOTS = 256  # Max replies waited for at once, must be a power of 2
+_SLOT_MASK = PENDING_SLOTS - 1
+MUSIC_BATCH = 16  # Max messages per write in music mode
+QUEUE_WARN_LENGTH = 10000  # Log when an unlimited queue gets this long
+
+# Sending on the connection that sent last the longest ago means the least waiting
+_LAST_SENT = attrgetter("last_sent")
+
+# Protocol values for the command arguments given as strings
+_FLOW_ENDSTATES = {"start": 0, "stop": 1, "off": 2}
+_CRON_ACTIONS = {"off": 0, "on": 1}
+_MUSIC_ACTIONS = {"stop": 0, "start": 1}
+
+# (light, property) -> method, the method name is also what "support" lists
+_PROP_METHODS = {
+    ("fg", "ct"): "set_ct_abx",
+    ("fg", "rgb"): "set_rgb",
+    ("fg", "hsv"): "set_hsv",
+    ("fg", "bright"): "set_bright",
+    ("bg", "ct"): "bg_set_ct_abx",
+    ("bg", "rgb"): "bg_set_rgb",
+    ("bg", "hsv"): "bg_set_hsv",
+}
+# (property, name) pairs of the colour and white proxies
+_COLOUR_KEYS = (("hue", "hue"), ("sat", "saturation"), ("bright", "brightness"))
+_WHITE_KEYS = (("bright", "brightness"), ("ct", "temperature"))
+# Methods only sent when the light is on
+_NEEDS_POWER = frozenset(
+    list(_PROP_METHODS.values()) + ["start_cf", "cron_add", "cron_del", "cron_get"]
+)
+
+
+def _cmd(method, params):
+    """Build a command message"""
+    return {"method": method, "params": params}
+
+
+@lru_cache(maxsize=64)
+def _msg_format(method):
+    """Message template with the method filled in, there are only a few methods"""
+    return b'{"id":%%d,"method":"%s","params":%%s}' % method.encode()
+
+
+@lru_cache(maxsize=32)
+def _flow_format(length):
+    """Format string for a flow expression of length items"""
+    # %s, not %d, so items are written as str() did, numeric strings included
+    return ",".join(["%s"] * length)
+
+
+def _encode(cid, method, params):
+    """Serialize a command. The id is only added here"""
+    return _msg_format(method) % (cid, _dumps(params))
 
 
 class Mode(IntEnum):
@@ -99,15 +191,12 @@ class Queue(object):
     """
 
     def __init__(self):
-        self.queue = []
+        self.queue = deque()
 
     def get(self):
-        try:
-            v = self.queue[0]
-            self.queue = self.queue[1:]
-            return v
-        except:
-            return None
+        if self.queue:
+            return self.queue.popleft()
+        return None
 
     def put(self, x):
         self.queue.append(x)
@@ -115,7 +204,7 @@ class Queue(object):
     def retrieve(self, idx):
         if idx < len(self.queue):
             v = self.queue[idx]
-            self.queue = self.queue[:idx] + self.queue[idx + 1 :]
+            del self.queue[idx]
             return v
         else:
             return None
@@ -124,7 +213,10 @@ class Queue(object):
         return len(self.queue) == 0
 
     def trim(self, length):
-        self.queue = self.queue[0 - length :]
+        """Keep only the last length elements. 0 means no limit"""
+        if length > 0:
+            while len(self.queue) > length:
+                self.queue.popleft()
 
     def __len__(self):
         return len(self.queue)
@@ -147,7 +239,9 @@ class XiaomiMusicConnect(aio.Protocol):
         self.future = future
         self.autoclose = autoclose
         self.transport = None
-        self.last_sent = dt.datetime.now()
+        self._clock = parent.loop.time  # Monotonic, in seconds
+        self.last_sent = self._clock()
+        self._close_handle = None
         # print("Music Mode Server Created")
 
     #
@@ -159,13 +253,18 @@ class XiaomiMusicConnect(aio.Protocol):
         """
 
         # print("Got connection from {}".format(transport.get_extra_info('peername')))
-        logging.debug(f"Connected to Yeelight via {transport}")
+        log.debug("Connected to Yeelight via %s", transport)
         self.transport = transport
         self.future.set_result(self)
         if self.autoclose:
-            xx = self.parent.loop.create_task(self._autoclose_me())
+            self._close_handle = self.parent.loop.call_later(
+                self.autoclose, self._autoclose_me
+            )
 
     def connection_lost(self, error):
+        if self._close_handle:
+            self._close_handle.cancel()
+            self._close_handle = None
         self.parent.music_mode_off()
 
     def data_received(self, data):
@@ -175,35 +274,57 @@ class XiaomiMusicConnect(aio.Protocol):
 
     def write(self, msg):
         # print("Music Sending {}".format(msg))
-        self.last_sent = dt.datetime.now()
-        self.transport.write((msg + "\r\n").encode())
+        self.last_sent = self._clock()
+        self.transport.writelines((msg, b"\r\n"))
+
+    def write_many(self, msgs):
+        """Send several messages with a single call to the transport, which can
+        then hand them all to one sendmsg()
+        """
+        self.last_sent = self._clock()
+        parts = []
+        for msg in msgs:
+            parts += (msg, b"\r\n")
+        self.transport.writelines(parts)
 
     def close(self):
         self.transport.close()
 
-    async def _autoclose_me(self):
-        while True:
-            if dt.datetime.now() - self.last_sent > dt.timedelta(
-                seconds=self.autoclose
-            ):
-                # print("Time to cleanup")
-                self.close()
-                return
-            await aio.sleep(1)
+    def _autoclose_me(self):
+        """Close when idle for long enough, or check again when that could be
+        """
+        idle = self._clock() - self.last_sent
+        if idle >= self.autoclose:
+            # print("Time to cleanup")
+            self._close_handle = None
+            self.close()
+        else:
+            self._close_handle = self.parent.loop.call_later(
+                self.autoclose - idle, self._autoclose_me
+            )
 
 
-class XiaomiConnect(aio.Protocol):
+class XiaomiConnect(aio.BufferedProtocol):
     """ This class is a single unicast connection to a Xiaomi device
 
+    Data is received straight into a buffer owned by the connection.
+
         :param parent: The parent object. Must have register, unregister and data_received methods
         :type parent: object
     """
 
+    bufsize = 4096  # Initial size of the receive buffer, it grows if needed
+
     def __init__(self, parent):
         self.parent = parent
         self.id = uuid4()
-        self.last_sent = dt.datetime.now() - dt.timedelta(seconds=2)
+        self._clock = parent.loop.time  # Monotonic, in seconds
+        self.last_sent = self._clock() - 2
         self.ip_addr = ""
+        self._pending = bytearray()
+        self._flush_scheduled = False
+        self._buf = bytearray(self.bufsize)
+        self._wpos = 0  # End of the data in _buf
 
     #
     # Protocol Methods
@@ -219,14 +340,58 @@ class XiaomiConnect(aio.Protocol):
         if self.parent:
             self.parent.unregister(self)
 
-    def data_received(self, data):
-        self.parent.data_received(data)
+    def get_buffer(self, sizehint):
+        if self._wpos == len(self._buf):
+            # A message longer than the buffer
+            self._buf = self._buf + bytearray(len(self._buf))
+        return memoryview(self._buf)[self._wpos :]
+
+    def buffer_updated(self, nbytes):
+        """Messages are "\r\n" terminated and TCP does not preserve their boundaries,
+        so pass on complete lines only.
+        """
+        buf = self._buf
+        end = self._wpos + nbytes
+        pos = 0
+        idx = buf.find(b"\r\n", max(0, self._wpos - 1), end)
+        while idx != -1:
+            if idx > pos:
+                self.parent.data_received(bytes(buf[pos:idx]))
+            pos = idx + 2
+            idx = buf.find(b"\r\n", pos, end)
+        if pos:
+            # The transport may still hold a view on buf, so copy without resizing
+            buf[: end - pos] = buf[pos:end]
+        self._wpos = end - pos
 
     def write(self, msg):
+        """Queue a message, all messages written during the same loop iteration
+        are sent together.
+        """
         # print("Sending {}".format(msg))
-        self.last_sent = dt.datetime.now()
-        logging.debug(f"Sending {msg}")
-        self.transport.write((msg + "\r\n").encode())
+        self.last_sent = self._clock()
+        log.debug("Sending %s", msg)
+        self._pending += msg
+        self._pending += b"\r\n"
+        if not self._flush_scheduled:
+            self._flush_scheduled = True
+            self.parent.loop.call_soon(self._flush)
+
+    def write_nodelay(self, msg):
+        """Send a message right away, along with anything still pending
+        """
+        self.last_sent = self._clock()
+        log.debug("Sending %s", msg)
+        self._pending += msg
+        self._pending += b"\r\n"
+        self._flush()
+
+    def _flush(self):
+        self._flush_scheduled = False
+        if self._pending:
+            if not self.transport.is_closing():
+                self.transport.write(bytes(self._pending))
+            self._pending.clear()
 
     def close(self):
         self.transport.close()
@@ -250,27 +415,31 @@ class XiaomiBulb(object):
 
      """
 
+    _MODE_RGB = Mode.RGB.value
+    _MODE_HSV = Mode.HSV.value
+
     def __init__(self, loop, headers, parent=None, tnb=1):
         self.loop = loop
         self.parent = parent
-        self.support = headers["support"]
+        if isinstance(headers["support"], str):
+            self.support = frozenset(headers["support"].split())
+        else:
+            self.support = frozenset(headers["support"])
         self.properties = {}
-        for key in headers:
-            if key in PROPERTIES:
-                if key in INT_PROPERTIES:
-                    self.properties[key] = int(headers[key])
-                elif key in HEX_PROPERTIES:
-                    self.properties[key] = int(headers[key], base=16)
-                else:
-                    self.properties[key] = headers[key]
-        self.ip_address = headers["location"].split("://")[1].split(":")[0]
-        self.port = headers["location"].split("://")[1].split(":")[1]
+        for key in headers:  # In header order, a set would shuffle the properties
+            if key in _PROPERTIES_SET:
+                conv = _COERCE.get(key)
+                self.properties[key] = conv(headers[key]) if conv else headers[key]
+        location = urlsplit(headers["location"])
+        self.ip_address = location.hostname
+        self.port = location.port
         self.seq = 0
-        # Key is the message sequence, value is a callable
-        self.pending_reply = {}
+        # Slot seq & _SLOT_MASK holds (seq, future, callable). Entries are cleared
+        # in data_received on reply and in try_sending on failure, a reply whose
+        # slot was since reused by a newer message is ignored.
+        self.pending_reply = [None] * PENDING_SLOTS
         self.tnb = max(1, min(4, tnb))  # Minimum 1, max 4 per Xiaomi specs
-        self.transports = []
-        self.tidx = 0
+        self.transports = {}  # Connections by id
         self.musicm = False
         self.timeout_secs = DEFAULT_TIMEOUT
         self.default_attempts = DEFAULT_ATTEMPTS
@@ -281,22 +450,52 @@ class XiaomiBulb(object):
         self.queue_policy = "drop"  # What to do when limit is reached
         self.is_sending = False
         self.my_ip_addr = ""
+        self._last_flex = (None, None, "")  # Last flow, its types and serialization
+        self._music_server = None  # Task creating the music mode server
+        self._music_port = None
+        self._music_delay = 0
+        self._tasks = set()  # Reference running tasks, so they can't be collected
 
     def activate(self):
-        # Start the transports
-        for x in range(self.tnb):
-            listen = self.loop.create_connection(
-                partial(XiaomiConnect, self), self.ip_address, self.port
-            )
-            xx = aio.ensure_future(listen)
+        """Start the transports, all connections are opened concurrently
+
+        Only the connections missing to reach the set number are opened, so this
+        can also be used to reconnect after some were lost.
+
+            :returns: a task done when all connection attempts are over. It can be
+                      awaited, but need not be.
+            :rtype: asyncio.Task
+        """
+        return self._spawn(self._connect(self.tnb - len(self.transports)))
+
+    def _spawn(self, coro):
+        """Run coro in a task that is referenced until it is done"""
+        task = self.loop.create_task(coro)
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+        return task
+
+    async def _connect(self, nb):
+        results = await aio.gather(
+            *[
+                self.loop.create_connection(
+                    partial(XiaomiConnect, self), self.ip_address, self.port
+                )
+                for x in range(nb)
+            ],
+            return_exceptions=True,
+        )
+        for res in results:
+            if isinstance(res, Exception):
+                log.warning("Cannot connect to %s: %r", self.ip_address, res)
 
     def seq_next(self):
         """Method to return the next sequence value to use in messages.
 
-            :returns: next number in sequensce (modulo 128)
+            :returns: next number in sequence (modulo MESSAGE_WINDOW)
             :rtype: int
         """
-        self.seq = (self.seq + 1) % MESSAGE_WINDOW
+        self.seq = (self.seq + 1) & _SEQ_MASK
         return self.seq
 
     async def try_sending(self, timeout_secs=None, max_attempts=None):
@@ -319,10 +518,14 @@ class XiaomiBulb(object):
                 timeout_secs = DEFAULT_TIMEOUT
             if max_attempts is None:
                 max_attempts = len(self.transports)  # So we can detect failure quickly
-            mydelta = dt.timedelta(seconds=1)
-            dodelay = len(self.transports) - 1
-            while not self.message_queue.empty():
-                callb, msg = self.message_queue.get()
+            # These do not change while sending, skip the attribute lookups
+            queue = self.message_queue
+            transports = self.transports.values()
+            pending = self.pending_reply
+            clock = self.loop.time
+            dodelay = len(transports) - 1
+            while not queue.empty():
+                callb, cid, data = queue.get()
                 if self.musicm:
                     if isinstance(self.musicm, aio.Future):
                         # print("Awaiting Future {}".format(self.musicm))
@@ -333,46 +536,58 @@ class XiaomiBulb(object):
                             # Oops
                             self.musicm = False
                             # print("Future Failed")
-                            self.message_queue.trim(self.queue_limit)
+                            queue.trim(self.queue_limit)
                             continue  # We just drop the extra messages
                         # print("Future gave {}".format(self.musicm))
-                    self.musicm.write(json.dumps(msg))
-                    if callb:
-                        callb({"id": msg["id"], "result": ["ok"]})
-                    if self.message_queue.empty():
+                    # No rate limit in music mode, send what is queued in one go
+                    batch = [(callb, cid, data)]
+                    while len(batch) < MUSIC_BATCH and not queue.empty():
+                        batch.append(queue.get())
+                    self.musicm.write_many([d for c, i, d in batch])
+                    for callb, cid, data in batch:
+                        if callb:
+                            callb({"id": cid, "result": ["ok"]})
+                    if queue.empty():
                         await aio.sleep(0.1)
                 else:
+                    if not transports:
+                        break
+                    slot_idx = cid & _SLOT_MASK
                     attempts = 0
+                    fut = None
                     while attempts < max_attempts:
-                        now = dt.datetime.now()
-                        cid = msg["id"]
-                        event = aio.Event()
-                        self.pending_reply[cid] = [event, callb]
+                        if fut is None or fut.done():
+                            # A timed out wait cancels the future, make a new one
+                            fut = self.loop.create_future()
+                            pending[slot_idx] = (cid, fut, callb)
                         attempts += 1
-                        myidx = self.tidx
-                        self.tidx = (self.tidx + 1) % len(self.transports)
-                        diff = now - self.transports[myidx].last_sent
-                        if diff < mydelta:
-                            await aio.sleep((mydelta - diff).total_seconds())
-                        self.transports[myidx].write(json.dumps(msg))
+                        conn = min(transports, key=_LAST_SENT)
+                        diff = clock() - conn.last_sent
+                        if diff < 1.0:
+                            await aio.sleep(1.0 - diff)
+                        conn.write(data)
                         try:
-                            myresult = await aio.wait_for(event.wait(), timeout_secs)
+                            if _timeout:
+                                async with _timeout(timeout_secs):
+                                    await fut
+                            else:
+                                await aio.wait_for(fut, timeout_secs)
                             break
                         except Exception as inst:
                             if attempts >= max_attempts:
-                                if cid in self.pending_reply:
-                                    callb = self.pending_reply[cid][1]
+                                slot = pending[slot_idx]
+                                if slot is not None and slot[0] == cid:
+                                    pending[slot_idx] = None
                                     if callb:
                                         callb(None)
-                                    del self.pending_reply[cid]
                                 # It's dead Jim
-                                self.unregister(self.transports[myidx])
-                                if len(self.transports) == 0:
+                                self.unregister(conn)
+                                if len(transports) == 0:
                                     self.is_sending = False
                                     return
                     if dodelay:
                         dodelay -= 1
-                        await aio.sleep(1.0 / len(self.transports))
+                        await aio.sleep(1.0 / len(transports))
         except:
             pass
         self.is_sending = False
@@ -381,63 +596,104 @@ class XiaomiBulb(object):
         """Sending a message by-passing the queue
         """
         cid = self.seq_next()
-        msg["id"] = cid
         if callb:
-            self.pending_reply[cid] = [None, callb]
-        self.transports[0].write(json.dumps(msg))
+            self.pending_reply[cid & _SLOT_MASK] = (cid, None, callb)
+        next(iter(self.transports.values())).write_nodelay(
+            _encode(cid, msg["method"], msg["params"])
+        )
 
     def send_msg(self, msg, callb=None, timeout_secs=None, max_attempts=None):
         """ Let's send
+
+        When the queue is full, what happens depends on the queue policy, see
+        set_queue_limit.
+
+            :returns: False if the message was dropped because the queue is full
+            :rtype: bool
         """
         # print("Sending {}".format(msg))
+        return self._send(
+            msg["method"], msg["params"], callb, timeout_secs, max_attempts
+        )
+
+    def _send(self, method, params, callb, timeout_secs=None, max_attempts=None):
+        """send_msg without the message dict, the commands use this directly"""
+        if (
+            callb is None
+            and max_attempts in (None, 1)
+            and not self.is_sending
+            and not self.musicm
+            and self.transports
+        ):
+            # Nothing to wait for. If a connection is not rate limited, just write
+            conn = min(self.transports.values(), key=_LAST_SENT)
+            if self.loop.time() - conn.last_sent >= 1.0:
+                conn.write(_encode(self.seq_next(), method, params))
+                return True
         if self.queue_limit == 0 or len(self.message_queue) < self.queue_limit:
             cid = self.seq_next()
-            msg["id"] = cid
-            self.message_queue.put((callb, msg))
+            self.message_queue.put((callb, cid, _encode(cid, method, params)))
+            if len(self.message_queue) == QUEUE_WARN_LENGTH:
+                log.warning(
+                    "%d messages waiting for %s, consider set_queue_limit",
+                    QUEUE_WARN_LENGTH,
+                    self.ip_address,
+                )
             if not self.is_sending:
                 self.is_sending = True
-                xxx = self.loop.create_task(
-                    self.try_sending(timeout_secs, max_attempts)
-                )
+                self._spawn(self.try_sending(timeout_secs, max_attempts))
         elif self.queue_limit > 0:
             if self.queue_policy != "drop":
                 cid = self.seq_next()
-                msg["id"] = cid
-                self.message_queue.put((callb, msg))
+                self.message_queue.put((callb, cid, _encode(cid, method, params)))
                 if self.queue_policy == "head":
                     x = self.message_queue.get()
                     del x
+                elif self.queue_policy == "newest":
+                    # Only what was just put is kept, so it goes out next
+                    self.message_queue.trim(1)
                 elif self.queue_policy == "adapt":
                     self.set_music("start", 5)
                 else:  # self.queue_policy == "random":
                     idx = randint(0, len(self.message_queue) - 1)
                     x = self.message_queue.retrieve(idx)
                     del x
+            else:
+                return False
+        return True
 
     def data_received(self, data):
-        # Do something
+        """Handle one message from the bulb, connections only pass on complete lines
+        """
+        log.debug("Received raw data: %r", data)
+        try:
+            received_data = _json.loads(data)
+        except ValueError:  # What all the JSON modules raise
+            log.warning("Ignoring malformed message from %s: %r", self.ip_address, data)
+            return
         try:
-            # print("Received raw data: {}".format(data))
-            received_data = json.loads(data)
             if "id" in received_data:
                 cid = int(received_data["id"])
-                if cid in self.pending_reply:
-                    myevent, callb = self.pending_reply[cid]
-                    if myevent:
-                        myevent.set()
+                slot = self.pending_reply[cid & _SLOT_MASK]
+                if slot is not None and slot[0] == cid:
+                    self.pending_reply[cid & _SLOT_MASK] = None
+                    cid, fut, callb = slot
+                    if fut and not fut.done():
+                        fut.set_result(received_data)
                     if callb:
                         callb(received_data)
-                    del self.pending_reply[cid]
 
             if "method" in received_data:
                 if received_data["method"] == "props":
-                    for prop, val in received_data["params"].items():
-                        if prop in PROPERTIES:
-                            self.properties[prop] = val
+                    params = received_data["params"]
+                    for prop in params:
+                        if prop in _PROPERTIES_SET:
+                            self.properties[prop] = params[prop]
 
                 self.default_callb(received_data["params"])
-        except:
-            pass
+        except Exception:
+            # Do not let a bad message or callback break the connection
+            log.exception("Error handling message %r", received_data)
 
     def register_callback(self, callb):
         """Method used to register a default call back to be called when data is received
@@ -461,16 +717,12 @@ class XiaomiBulb(object):
             :type props: list
             :param callb: a callback function. Given the list of values as parameters
             :type callb: callable
-            :returns: True if supported, False if not
+            :returns: False if not supported, or dropped by the queue policy
             :rtype: bool
         """
-        if "get_prop" in self.support:
-            self.send_msg(
-                {"method": "get_prop", "params": props},
-                partial(self._get_prop_reply, props, callb),
-            )
-            return True
-        return False
+        return self._invoke(
+            "get_prop", props, partial(self._get_prop_reply, props, callb)
+        )
 
     def _get_prop_reply(self, request, callb, result):
         """Get current values of light properties
@@ -485,13 +737,9 @@ class XiaomiBulb(object):
             and ("music_on" not in self.properties or self.properties["music_on"] != 1)
         ):
             for prop, val in zip(request, result["result"]):
-                if prop in PROPERTIES:
-                    if prop in INT_PROPERTIES:
-                        self.properties[prop] = int(val)
-                    elif prop in HEX_PROPERTIES:
-                        self.properties[prop] = int(val, base=16)
-                    else:
-                        self.properties[prop] = val
+                if prop in _PROPERTIES_SET:
+                    conv = _COERCE.get(prop)
+                    self.properties[prop] = conv(val) if conv else val
             if callb:
                 callb(result)
 
@@ -514,6 +762,52 @@ class XiaomiBulb(object):
         if callb:
             callb(result)
 
+    def _require(self, feature, needs_power=False):
+        """Check that the light knows a method and, if required, is on
+
+            :param feature: The command method
+            :type feature: str
+            :param needs_power: Whether the light must be on
+            :type needs_power: bool
+            :returns: True if the command can be sent
+            :rtype: bool
+        """
+        return feature in self.support and (
+            not needs_power or self.properties.get("power") == "on"
+        )
+
+    def _invoke(self, method, params, callb):
+        """Send a command, if the light knows the method and, when needed, is on
+
+            :param method: The command method
+            :type method: str
+            :param params: The command parameters
+            :type params: tuple
+            :returns: False if not supported, or dropped by the queue policy
+            :rtype: bool
+        """
+        if self._require(method, method in _NEEDS_POWER):
+            return self._send(method, params, callb)
+        return False
+
+    def _send_prop(self, fam, prop, values, effect, duration, callb):
+        """Common part of the set_* methods changing one property of the light
+
+            :param fam: "fg" for the main light, "bg" for the background light
+            :type fam: str
+            :param prop: The property family, one of "ct", "rgb", "hsv" or "bright"
+            :type prop: str
+            :param values: The property value(s)
+            :type values: tuple
+            :returns: False if not supported, or dropped by the queue policy
+            :rtype: bool
+        """
+        if effect == "smooth":
+            duration = max(30, duration)  # Min is 30 msecs
+        return self._invoke(
+            _PROP_METHODS[fam, prop], values + (effect, duration), callb
+        )
+
     def set_temperature(self, temp, effect="sudden", duration=100, callb=None):
         """Set temperature of light
 
@@ -525,17 +819,10 @@ class XiaomiBulb(object):
             :type duration: int
             :param callb: a callback function. Given the list of values as parameters
             :type callb: callable
-            :returns: None
-            :rtype: None
+            :returns: False if not supported, or dropped by the queue policy
+            :rtype: bool
         """
-        if self.properties["power"] == "on" and "set_ct_abx" in self.support:
-            if effect == "smooth":
-                duration = max(30, duration)  # Min is 30 msecs
-            self.send_msg(
-                {"method": "set_ct_abx", "params": [temp, effect, duration]}, callb
-            )
-            return True
-        return False
+        return self._send_prop("fg", "ct", (temp,), effect, duration, callb)
 
     def set_rgb(self, rgb, effect="sudden", duration=100, callb=None):
 
@@ -549,18 +836,10 @@ class XiaomiBulb(object):
             :type duration: int
             :param callb: a callback function. Given the list of values as parameters
             :type callb: callable
-            :returns: None
-            :rtype: None
+            :returns: False if not supported, or dropped by the queue policy
+            :rtype: bool
         """
-        if self.properties["power"] == "on" and "set_rgb" in self.support:
-            cid = self.seq_next()
-            if effect == "smooth":
-                duration = max(30, duration)  # Min is 30 msecs
-            self.send_msg(
-                {"method": "set_rgb", "params": [rgb, effect, duration]}, callb
-            )
-            return True
-        return False
+        return self._send_prop("fg", "rgb", (rgb,), effect, duration, callb)
 
     def set_hsv(self, hue, sat, effect="sudden", duration=100, callb=None):
 
@@ -576,17 +855,10 @@ class XiaomiBulb(object):
             :type duration: int
             :param callb: a callback function. Given the list of values as parameters
             :type callb: callable
-            :returns: None
-            :rtype: None
+            :returns: False if not supported, or dropped by the queue policy
+            :rtype: bool
         """
-        if self.properties["power"] == "on" and "set_hsv" in self.support:
-            if effect == "smooth":
-                duration = max(30, duration)  # Min is 30 msecs
-            self.send_msg(
-                {"method": "set_hsv", "params": [hue, sat, effect, duration]}, callb
-            )
-            return True
-        return False
+        return self._send_prop("fg", "hsv", (hue, sat), effect, duration, callb)
 
     def set_brightness(self, brightness, effect="sudden", duration=100, callb=None):
 
@@ -600,18 +872,10 @@ class XiaomiBulb(object):
             :type duration: int
             :param callb: a callback function. Given the list of values as parameters
             :type callb: callable
-            :returns: None
-            :rtype: None
+            :returns: False if not supported, or dropped by the queue policy
+            :rtype: bool
         """
-        if self.properties["power"] == "on" and "set_bright" in self.support:
-            if effect == "smooth":
-                duration = max(30, duration)  # Min is 30 msecs
-                self.send_msg(
-                    {"method": "set_bright", "params": [brightness, effect, duration]},
-                    callb,
-                )
-            return True
-        return False
+        return self._send_prop("fg", "bright", (brightness,), effect, duration, callb)
 
     def set_power(self, power, effect="sudden", duration=100, mode=None, callb=None):
 
@@ -627,23 +891,14 @@ class XiaomiBulb(object):
             :type mode: Mode
             :param callb: a callback function. Given the list of values as parameters
             :type callb: callable
-            :returns: None
-            :rtype: None
+            :returns: False if not supported, or dropped by the queue policy
+            :rtype: bool
         """
-        if "set_power" in self.support:
-            if effect == "smooth":
-                duration = max(30, duration)  # Min is 30 msecs
-            if mode:
-                self.send_msg(
-                    {"method": "set_power", "params": [power, effect, duration, mode]},
-                    callb,
-                )
-            else:
-                self.send_msg(
-                    {"method": "set_power", "params": [power, effect, duration]}, callb
-                )
-            return True
-        return False
+        if effect == "smooth":
+            duration = max(30, duration)  # Min is 30 msecs
+        if mode:
+            return self._invoke("set_power", (power, effect, duration, mode), callb)
+        return self._invoke("set_power", (power, effect, duration), callb)
 
     def set_default(self, callb=None):
 
@@ -651,13 +906,10 @@ class XiaomiBulb(object):
 
             :param callb: a callback function. Given the list of values as parameters
             :type callb: callable
-            :returns: None
-            :rtype: None
+            :returns: False if not supported, or dropped by the queue policy
+            :rtype: bool
         """
-        if "set_default" in self.support:
-            self.send_msg({"method": "set_default", "params": []}, callb)
-            return True
-        return False
+        return self._invoke("set_default", (), callb)
 
     def bg_set_temperature(self, temp, effect="sudden", duration=100, callb=None):
         """Set temperature of light
@@ -670,17 +922,10 @@ class XiaomiBulb(object):
             :type duration: int
             :param callb: a callback function. Given the list of values as parameters
             :type callb: callable
-            :returns: None
-            :rtype: None
+            :returns: False if not supported, or dropped by the queue policy
+            :rtype: bool
         """
-        if self.properties["power"] == "on" and "bg_set_ct_abx" in self.support:
-            if effect == "smooth":
-                duration = max(30, duration)  # Min is 30 msecs
-            self.send_msg(
-                {"method": "bg_set_ct_abx", "params": [temp, effect, duration]}, callb
-            )
-            return True
-        return False
+        return self._send_prop("bg", "ct", (temp,), effect, duration, callb)
 
     def bg_set_rgb(self, rgb, effect="sudden", duration=100, callb=None):
 
@@ -694,17 +939,10 @@ class XiaomiBulb(object):
             :type duration: int
             :param callb: a callback function. Given the list of values as parameters
             :type callb: callable
-            :returns: None
-            :rtype: None
+            :returns: False if not supported, or dropped by the queue policy
+            :rtype: bool
         """
-        if self.properties["power"] == "on" and "bg_set_rgb" in self.support:
-            if effect == "smooth":
-                duration = max(30, duration)  # Min is 30 msecs
-            self.send_msg(
-                {"method": "set_rgb", "params": [rgb, effect, duration]}, callb
-            )
-            return True
-        return False
+        return self._send_prop("bg", "rgb", (rgb,), effect, duration, callb)
 
     def bg_set_hsv(self, hue, sat, effect="sudden", duration=100, callb=None):
 
@@ -720,17 +958,10 @@ class XiaomiBulb(object):
             :type duration: int
             :param callb: a callback function. Given the list of values as parameters
             :type callb: callable
-            :returns: None
-            :rtype: None
+            :returns: False if not supported, or dropped by the queue policy
+            :rtype: bool
         """
-        if self.properties["power"] == "on" and "bg_set_hsv" in self.support:
-            if effect == "smooth":
-                duration = max(30, duration)  # Min is 30 msecs
-            self.send_msg(
-                {"method": "bg_set_hsv", "params": [hue, sat, effect, duration]}, callb
-            )
-            return True
-        return False
+        return self._send_prop("bg", "hsv", (hue, sat), effect, duration, callb)
 
     def toggle(self, callb=None):
 
@@ -738,13 +969,10 @@ class XiaomiBulb(object):
 
             :param callb: a callback function. Given the list of values as parameters
             :type callb: callable
-            :returns: None
-            :rtype: None
+            :returns: False if not supported, or dropped by the queue policy
+            :rtype: bool
         """
-        if "toggle" in self.support:
-            self.send_msg({"method": "toggle", "params": []}, callb)
-            return True
-        return False
+        return self._invoke("toggle", (), callb)
 
     def bg_toggle(self, callb=None):
 
@@ -752,13 +980,10 @@ class XiaomiBulb(object):
 
             :param callb: a callback function. Given the list of values as parameters
             :type callb: callable
-            :returns: None
-            :rtype: None
+            :returns: False if not supported, or dropped by the queue policy
+            :rtype: bool
         """
-        if "bg_toggle" in self.support:
-            self.send_msg({"method": "bg_toggle", "params": []}, callb)
-            return True
-        return False
+        return self._invoke("bg_toggle", (), callb)
 
     def dev_toggle(self, callb=None):
 
@@ -766,13 +991,10 @@ class XiaomiBulb(object):
 
             :param callb: a callback function. Given the list of values as parameters
             :type callb: callable
-            :returns: None
-            :rtype: None
+            :returns: False if not supported, or dropped by the queue policy
+            :rtype: bool
         """
-        if "bg_toggle" in self.support:
-            self.send_msg({"method": "bg_toggle", "params": []}, callb)
-            return True
-        return False
+        return self._invoke("bg_toggle", (), callb)
 
     def start_flow(self, count, endstate, flex, callb=None):
 
@@ -794,23 +1016,28 @@ class XiaomiBulb(object):
             :type flex: list
             :param callb: a callback function. Given the list of values as parameters
             :type callb: callable
-            :returns: None
-            :rtype: None
+            :returns: False if not supported, or dropped by the queue policy
+            :rtype: bool
         """
-        if self.properties["power"] == "on" and "start_cf" in self.support:
-            self.send_msg(
-                {
-                    "method": "start_cf",
-                    "params": [
-                        count,
-                        ["start", "stop", "off"].index(endstate.lower()),
-                        ",".join(map(str, flex)),
-                    ],
-                },
-                callb,
-            )
-            return True
-        return False
+        if not self._require("start_cf", True):
+            return False
+        try:
+            endstate = _FLOW_ENDSTATES[endstate.lower()]
+        except KeyError:
+            return False
+        return self._send(
+            "start_cf", (count, endstate, self._flow_expression(flex)), callb
+        )
+
+    def _flow_expression(self, flex):
+        """Serialize a flow, remembering the last one as flows are often resent
+        """
+        key = tuple(flex)
+        # With the types, as 1, 1.0 and True are equal but are not written the same
+        types = tuple(map(type, key))
+        if key != self._last_flex[0] or types != self._last_flex[1]:
+            self._last_flex = (key, types, _flow_format(len(key)) % key)
+        return self._last_flex[2]
 
     def stop_flow(self, callb=None):
 
@@ -818,13 +1045,10 @@ class XiaomiBulb(object):
 
             :param callb: a callback function. Given the list of values as parameters
             :type callb: callable
-            :returns: None
-            :rtype: None
+            :returns: False if not supported, or dropped by the queue policy
+            :rtype: bool
         """
-        if "stop_cf" in self.support:
-            self.send_msg({"method": "stop_cf", "params": []}, callb)
-            return True
-        return False
+        return self._invoke("stop_cf", (), callb)
 
     def set_rgb_direct(self, rgb, brightness, callb=None):
 
@@ -834,15 +1058,10 @@ class XiaomiBulb(object):
             :type rgb: int
             :param brightness: The brightness
             :type brightness: int
-            :returns: None
-            :rtype: None
+            :returns: False if not supported, or dropped by the queue policy
+            :rtype: bool
         """
-        if "set_scene" in self.support:
-            self.send_msg(
-                {"method": "set_scene", "params": ["color", rgb, brightness]}, callb
-            )
-            return True
-        return False
+        return self._invoke("set_scene", ("color", rgb, brightness), callb)
 
     def set_hsv_direct(self, hue, sat, brightness, callb=None):
 
@@ -855,15 +1074,10 @@ class XiaomiBulb(object):
             :param brightness: The brightness
             :type brightness: int
             :type callb: callable
-            :returns: None
-            :rtype: None
+            :returns: False if not supported, or dropped by the queue policy
+            :rtype: bool
         """
-        if "set_scene" in self.support:
-            self.send_msg(
-                {"method": "set_scene", "params": ["hsv", hue, sat, brightness]}, callb
-            )
-            return True
-        return False
+        return self._invoke("set_scene", ("hsv", hue, sat, brightness), callb)
 
     def set_white_direct(self, temperature, brightness, callb=None):
 
@@ -875,16 +1089,10 @@ class XiaomiBulb(object):
             :type brightness: int
             :param callb: a callback function. Given the list of values as parameters
             :type callb: callable
-            :returns: None
-            :rtype: None
+            :returns: False if not supported, or dropped by the queue policy
+            :rtype: bool
         """
-        if "set_scene" in self.support:
-            self.send_msg(
-                {"method": "set_scene", "params": ["ct", temperature, brightness]},
-                callb,
-            )
-            return True
-        return False
+        return self._invoke("set_scene", ("ct", temperature, brightness), callb)
 
     def set_flow_direct(self, count, endstate, flex, callb=None):
         """Set colour flow of light
@@ -905,25 +1113,15 @@ class XiaomiBulb(object):
             :type brightness: list
             :param callb: a callback function. Given the list of values as parameters
             :type callb: callable
-            :returns: None
-            :rtype: None
+            :returns: False if not supported, or dropped by the queue policy
+            :rtype: bool
         """
 
-        if "set_scene" in self.support:
-            self.send_msg(
-                {
-                    "method": "set_scene",
-                    "params": [
-                        "cf",
-                        count,
-                        ["start", "stop", "off"].index(endstate.lower()),
-                        flex,
-                    ],
-                },
-                callb,
-            )
-            return True
-        return False
+        try:
+            endstate = _FLOW_ENDSTATES[endstate.lower()]
+        except KeyError:
+            return False
+        return self._invoke("set_scene", ("cf", count, endstate, flex), callb)
 
     def set_timed_power(self, brightness, delay, callb=None):
 
@@ -935,19 +1133,10 @@ class XiaomiBulb(object):
             :type brightness: int
             :param callb: a callback function. Given the list of values as parameters
             :type callb: callable
-            :returns: None
-            :rtype: None
+            :returns: False if not supported, or dropped by the queue policy
+            :rtype: bool
         """
-        if "set_scene" in self.support:
-            self.send_msg(
-                {
-                    "method": "set_scene",
-                    "params": ["auto_delay_off", brightness, delay],
-                },
-                callb,
-            )
-            return True
-        return False
+        return self._invoke("set_scene", ("auto_delay_off", brightness, delay), callb)
 
     def cron_add(self, action, delay, callb=None):
 
@@ -959,19 +1148,14 @@ class XiaomiBulb(object):
             :type delay: int
             :param callb: a callback function. Given the list of values as parameters
             :type callb: callable
-            :returns: None
-            :rtype: None
+            :returns: False if not supported, or dropped by the queue policy
+            :rtype: bool
         """
-        if self.properties["power"] == "on" and "cron_add" in self.support:
-            self.send_msg(
-                {
-                    "method": "cron_add",
-                    "params": [["off", "on"].index(action.lower()), delay],
-                },
-                callb,
-            )
-            return True
-        return False
+        try:
+            action = _CRON_ACTIONS[action.lower()]
+        except KeyError:
+            return False
+        return self._invoke("cron_add", (action, delay), callb)
 
     def cron_del(self, action, callb=None):
 
@@ -981,16 +1165,14 @@ class XiaomiBulb(object):
             :type action: str
             :param callb: a callback function. Given the list of values as parameters
             :type callb: callable
-            :returns: None
-            :rtype: None
+            :returns: False if not supported, or dropped by the queue policy
+            :rtype: bool
         """
-        if self.properties["power"] == "on" and "cron_del" in self.support:
-            self.send_msg(
-                {"method": "cron_del", "params": [["off", "on"].index(action.lower())]},
-                callb,
-            )
-            return True
-        return False
+        try:
+            action = _CRON_ACTIONS[action.lower()]
+        except KeyError:
+            return False
+        return self._invoke("cron_del", (action,), callb)
 
     def cron_get(self, action, callb=None):
 
@@ -1000,16 +1182,14 @@ class XiaomiBulb(object):
             :type action: str
             :param callb: a callback function. Given the list of values as parameters
             :type callb: callable
-            :returns: None
-            :rtype: None
+            :returns: False if not supported, or dropped by the queue policy
+            :rtype: bool
         """
-        if self.properties["power"] == "on" and "cron_get" in self.support:
-            self.send_msg(
-                {"method": "cron_get", "params": [["off", "on"].index(action.lower())]},
-                callb,
-            )
-            return True
-        return False
+        try:
+            action = _CRON_ACTIONS[action.lower()]
+        except KeyError:
+            return False
+        return self._invoke("cron_get", (action,), callb)
 
     # TODO implement these
     # def set_adjust 2 string(action) string(prop)
@@ -1027,48 +1207,54 @@ class XiaomiBulb(object):
             :type delay: float
             :param callb: a callback function. Given the list of values as parameters
             :type callb: callable
-            :returns: None
-            :rtype: None
+            :returns: True if the command was sent, False if not
+            :rtype: bool
         """
-        if "set_music" in self.support:
+        if self._require("set_music"):
 
             if action.lower() == "start" and not self.musicm:
-                while True:
+                server = self._music_server
+                if (
+                    server is None
+                    or server.cancelled()
+                    or (server.done() and server.exception())
+                ):
+                    # The server is kept for the next times music mode is started
+                    sock = socket.socket()
                     try:
-                        myport = randint(9000, 24376)
-                        sock = socket.socket()
-                        sock.bind(
-                            (self.my_ip_addr, myport)
-                        )  # Make sure the port is free
-                        break
-                    except:
-                        pass
-                self.musicm = aio.Future()
+                        sock.setblocking(False)
+                        # Let the system pick a free port
+                        sock.bind((self.my_ip_addr, 0))
+                    except OSError as e:
+                        sock.close()
+                        log.warning(
+                            "Cannot listen for music mode on %s: %s", self.my_ip_addr, e
+                        )
+                        return False
+                    self._music_port = sock.getsockname()[1]
+                    self._music_server = self._spawn(
+                        self.loop.create_server(self._music_connection, sock=sock)
+                    )
+                self.musicm = self.loop.create_future()
+                self._music_delay = delay
                 # print("Start Future {}".format(self.musicm))
-                coro = self.loop.create_server(
-                    partial(XiaomiMusicConnect, self, self.musicm, delay), sock=sock
-                )
-                xx = aio.ensure_future(coro)
                 # self.loop.call_soon(self.set_music,"start",self.my_ip_addr,myport)
                 self.loop.call_soon(
                     self.send_msg_noqueue,
-                    {
-                        "method": "set_music",
-                        "params": [
-                            ["stop", "start"].index(action.lower()),
+                    _cmd(
+                        "set_music",
+                        (
+                            _MUSIC_ACTIONS[action.lower()],
                             self.my_ip_addr,
-                            myport,
-                        ],
-                    },
+                            self._music_port,
+                        ),
+                    ),
                     callb,
                 )
             elif action.lower() == "stop" and self.musicm:
                 self.loop.call_soon(
                     self.send_msg_noqueue,
-                    {
-                        "method": "set_music",
-                        "params": [["stop", "start"].index(action.lower())],
-                    },
+                    _cmd("set_music", (_MUSIC_ACTIONS[action.lower()],)),
                     callb,
                 )
                 self.music_mode_off()
@@ -1077,6 +1263,23 @@ class XiaomiBulb(object):
             return True
         return False
 
+    def _music_connection(self):
+        """Protocol factory of the music mode server"""
+        if isinstance(self.musicm, aio.Future) and not self.musicm.done():
+            future = self.musicm
+        else:  # Not waited for
+            future = self.loop.create_future()
+        return XiaomiMusicConnect(self, future, self._music_delay)
+
+    def _close_music_server(self):
+        server, self._music_server = self._music_server, None
+        if server is None:
+            return
+        if not server.done():
+            server.cancel()
+        elif not server.cancelled() and server.exception() is None:
+            server.result().close()
+
     def set_name(self, name, callb=None):
 
         """Set light name
@@ -1085,13 +1288,10 @@ class XiaomiBulb(object):
             :type name: str
             :param callb: a callback function. Given the list of values as parameters
             :type callb: callable
-            :returns: None
-            :rtype: None
+            :returns: False if not supported, or dropped by the queue policy
+            :rtype: bool
         """
-        if "set" in self.support:
-            self.send_msg({"method": "set_name", "params": [name]}, callb)
-            return True
-        return False
+        return self._invoke("set_name", (name,), callb)
 
     #
     # Management Methods
@@ -1100,7 +1300,7 @@ class XiaomiBulb(object):
             return True
         return False
         """
-        self.transports.append(conn)
+        self.transports[conn.id] = conn
         # print("Registering connection {} for {}".format(conn,self.bulb_id))
         if not self.registered:
             self.my_ip_addr = conn.transport.get_extra_info("sockname")[0]
@@ -1112,26 +1312,31 @@ class XiaomiBulb(object):
         """Proxy method to unregister the device with the parent.
         """
         # print("Unregistering connection {} for {}".format(conn,self.bulb_id))
-        for x in range(len(self.transports)):
-            if self.transports[x].id == conn.id:
-                try:
-                    self.transports[x].close()
-                except:
-                    pass
+        if self.transports.pop(conn.id, None):
+            try:
+                conn.close()
+            except:
+                pass
 
-                del self.transports[x]
-                break
-
-        if len(self.transports) == 0 and self.registered:
+        if not self.transports and self.registered:
             self.registered = False
             if self.parent:
                 self.parent.unregister(self)
 
     def cleanup(self):
         """Method to call to cleanly terminate the connection to the device.
+
+        It is safe to call more than once.
         """
-        for x in self.tranports:
-            x.close()
+        conns = list(self.transports.values())
+        self.transports.clear()
+        for x in conns:
+            try:
+                x.close()
+            except:
+                pass
+        self.music_mode_off()
+        self._close_music_server()
 
     def set_connections(self, nb):
         """Function to set the number of connection to open to a single bulb.
@@ -1155,6 +1360,7 @@ class XiaomiBulb(object):
                     drop: drop the extra messages
                     head: drop the head of the queu
                     random: drop a random message in the queue
+                    newest: drop all the queued messages, only the new one is sent
                     adapt: switch to "music" mode and send
         """
         self.queue_limit = length
@@ -1176,74 +1382,62 @@ class XiaomiBulb(object):
             self.musicm = False
 
     # A couple of proxies
+    def _remap(self, keys):
+        """Dictionary of the given properties under new names, 0 when not known
+
+            :param keys: (property, name) pairs
+            :type keys: tuple
+        """
+        props = self.properties
+        return {name: props.get(prop, 0) for prop, name in keys}
+
+    def snapshot(self):
+        """All the known properties at once
+
+            :returns: A copy of the property values, by property name
+            :rtype: dict
+        """
+        return dict(self.properties)
+
     @property
     def power(self):
-        if "power" in self.properties:
-            return self.properties["power"]
-        else:
-            return "off"
+        return self.properties.get("power", "off")
 
     @property
     def colour(self):
-        result = {"hue": 0, "saturation": 0, "brightness": 0}
-        if "sat" in self.properties:
-            result["saturation"] = self.properties["sat"]
-        if "hue" in self.properties:
-            result["hue"] = self.properties["hue"]
-        if "bright" in self.properties:
-            result["brightness"] = self.properties["bright"]
-
-        return result
+        return self._remap(_COLOUR_KEYS)
 
     @property
     def rgb(self):
-        result = {"red": 0, "green": 0, "blue": 0}
-        if "rgb" in self.properties:
-            val = int(self.properties["rgb"])
-            for col in ["blue", "green", "red"]:
-                result[col] = val % 256
-                val = int((val - result[col]) / 256)
-
-            return result
-        else:
-            return result
+        val = int(self.properties.get("rgb", 0))
+        return {
+            "red": (val >> 16) & 0xFF,
+            "green": (val >> 8) & 0xFF,
+            "blue": val & 0xFF,
+        }
 
     @property
     def brightness(self):
-        if "bright" in self.properties:
-            return int(self.properties["bright"])
-        else:
-            return 0
+        return int(self.properties.get("bright", 0))
 
     @property
     def white(self):
-        result = {"brightness": 0, "temperature": 0}
-        if "ct" in self.properties:
-            result["temperature"] = self.properties["ct"]
-        if "bright" in self.properties:
-            result["brightness"] = self.properties["bright"]
-
-        return result
+        return self._remap(_WHITE_KEYS)
 
     @property
     def current_colour(self):
-        if self.properties["color_mode"] == Mode.RGB.value:
+        mode = self.properties.get("color_mode")
+        if mode == self._MODE_RGB:
             return self.rgb
-        elif self.properties["color_mode"] == Mode.HSV.value:
+        elif mode == self._MODE_HSV:
             return self.colour
         else:
             return self.white
 
     @property
     def name(self):
-        if "name" in self.properties:
-            return self.properties["name"]
-        else:
-            return None
+        return self.properties.get("name")
 
     @property
     def bulb_id(self):
-        if "id" in self.properties:
-            return self.properties["id"]
-        else:
-            return None
+        return self.properties.get("id")
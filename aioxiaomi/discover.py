@@ -9,6 +9,7 @@ log = logging.getLogger(__name__)
 UPNP_PORT = 1982
 UPNP_ADDR = "239.255.255.250"
 _DISCOVERYTIMEOUT = 360
+_tasks = set()  # Reference running tasks, so they can't be collected
 
 
 class UPnPLoopbackException(Exception):
@@ -32,41 +33,42 @@ class XiaomiUPnP(aio.Protocol):
         self.broadcast_cnt = 0
         self.future = future
         self.discovery_timeout = _DISCOVERYTIMEOUT
+        # The discovery message never changes
+        self._msearch = "\r\n".join(
+            (
+                "M-SEARCH * HTTP/1.1",
+                "HOST:{}:{}".format(addr, UPNP_PORT),
+                "ST:wifi_bulb",
+                "MX:2",
+                'MAN:"ssdp:discover"',
+                "",
+                "",
+            )
+        ).encode("ascii")
+        self._target = (addr, UPNP_PORT)
 
     def connection_made(self, transport):
         self.transport = transport
         self.future.set_result(self)
         sock = self.transport.get_extra_info("socket")
-        # sock.settimeout(3)
-        addrinfo = socket.getaddrinfo(self.addr, None)[0]
         ttl = pack("@i", 1)
         sock.setsockopt(socket.IPPROTO_IP, socket.IP_MULTICAST_TTL, ttl)
+        # No need to get our own M-SEARCH back
+        sock.setsockopt(socket.IPPROTO_IP, socket.IP_MULTICAST_LOOP, 0)
 
     def broadcast_once(self):
         """Send the discovery mesage broadcast_once
         """
-        request = "\r\n".join(
-            (
-                "M-SEARCH * HTTP/1.1",
-                "HOST:{}:{}",
-                "ST:wifi_bulb",
-                "MX:2",
-                'MAN:"ssdp:discover"',
-                "",
-                "",
-            )
-        ).format(self.addr, UPNP_PORT)
-        self.transport.sendto(request.encode(), (self.addr, UPNP_PORT))
+        self.transport.sendto(self._msearch, self._target)
 
     def datagram_received(self, data, addr):
         # print("Received datagram: {}".format(data))
         headers = {}
-        for line in data.decode("ascii").split("\r\n"):
-            try:
-                header, value = line.split(":", 1)
-                headers[header.lower()] = value.strip()
-            except:
-                pass
+        for line in data.split(b"\r\n"):
+            if b":" in line:
+                header, value = line.split(b":", 1)
+                header = header.lower().decode("ascii", "replace")
+                headers[header] = value.strip().decode("utf-8", "replace")
 
         if self.handler:
             self.handler(addr, headers)
@@ -81,18 +83,23 @@ class XiaomiUPnP(aio.Protocol):
         pass
 
     def broadcast(self, seconds, timeout=_DISCOVERYTIMEOUT):
+        """Broadcast every second for seconds, then wait timeout secs and start again
+        """
         self.discovery_timeout = timeout
-        self.task = aio.get_event_loop().create_task(self._do_broadcast(seconds))
-
-    async def _do_broadcast(self, seconds):
-        count = seconds
-        while True:
-            if count == 0:
-                count = seconds
-                await aio.sleep(self.discovery_timeout)
-            self.broadcast_once()
-            count -= 1
-            await aio.sleep(1)
+        self._seconds = seconds
+        self._remaining = seconds
+        # A timer handle, like a task it can be cancelled
+        self.task = self.loop.call_soon(self._do_broadcast)
+
+    def _do_broadcast(self):
+        self.broadcast_once()
+        self._remaining -= 1
+        if self._remaining == 0:
+            self._remaining = self._seconds
+            delay = 1 + self.discovery_timeout
+        else:
+            delay = 1
+        self.task = self.loop.call_later(delay, self._do_broadcast)
 
     def close(self):
         try:
@@ -101,15 +108,33 @@ class XiaomiUPnP(aio.Protocol):
             pass
 
 
-def start_xiaomi_discovery(handler):
+def start_xiaomi_discovery(handler, loop=None):
+    """Start listening for Yeelight bulbs on the current event loop
+
+    The library never changes the event loop policy. To run on uvloop, install it
+    (uvloop.install()) before the loop is created, as the test program does.
+
+        :param handler: Called with the sender address and the headers of each reply
+        :type handler: callable
+        :param loop: The event loop, defaults to the running one
+        :type loop: asyncio.AbstractEventLoop
+        :returns: a future whose result is the XiaomiUPnP protocol
+        :rtype: asyncio.Future
+    """
     addrinfo = socket.getaddrinfo(UPNP_ADDR, None)[0]
     sock = socket.socket(addrinfo[0], socket.SOCK_DGRAM)
-    loop = aio.get_event_loop()
-    future = aio.Future()
+    if loop is None:
+        try:
+            loop = aio.get_running_loop()
+        except RuntimeError:  # Called before the loop runs
+            loop = aio.get_event_loop()
+    future = loop.create_future()
     connect = loop.create_datagram_endpoint(
         lambda: XiaomiUPnP(loop, UPNP_ADDR, handler, future), sock=sock
     )
-    x = aio.ensure_future(connect)
+    task = loop.create_task(connect)
+    _tasks.add(task)
+    task.add_done_callback(_tasks.discard)
     return future
 
 
@@ -122,7 +147,7 @@ def test():
         print(sender[0], args)
 
     loop = aio.get_event_loop()
-    connect = start_xiaomi_discovery(handler)
+    connect = start_xiaomi_discovery(handler, loop)
     broadcaster[UPNP_ADDR] = loop.run_until_complete(connect)
     print("{}".format(broadcaster))
     broadcaster[UPNP_ADDR].broadcast(2)
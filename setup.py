@@ -21,6 +21,7 @@ setuptools.setup(
     keywords=["yeelight", "light", "automation", "xiaomi"],
     license="MIT",
     install_requires=[],
+    extras_require={"speed": ["orjson", "uvloop"]},
     # See https://pypi.python.org/pypi?%3Aaction=list_classifiers
     classifiers=[
         # Pick your license as you wish (should match "license" above)